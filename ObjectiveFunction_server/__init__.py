@@ -1,4 +1,4 @@
-from .application import app, db  # noqa F401
+from .application import app, db, auth  # noqa F401
 from .routes import *  # noqa F401 F403
 from .models import *  # noqa F401 F403
 import logging
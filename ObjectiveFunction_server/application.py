@@ -1,7 +1,31 @@
 from flask import Flask
 from .config import Config
 from flask_sqlalchemy import SQLAlchemy
+from flask_httpauth import HTTPBasicAuth
+from flask_compress import Compress
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import sqlite3
 
 app = Flask(__name__)
 app.config.from_object(Config)
 db = SQLAlchemy(app)
+auth = HTTPBasicAuth()
+Compress(app)
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """configure sqlite databases
+
+    enforce foreign key constraints and use write-ahead logging so that
+    readers are not blocked while a request commits
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA mmap_size=268435456')
+        cursor.close()
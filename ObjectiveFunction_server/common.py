@@ -1,9 +1,9 @@
 __all__ = ['RunType', 'LookupState']
 
-from enum import Enum
+from enum import IntEnum
 
 
-class RunType(Enum):
+class RunType(IntEnum):
     """the available run types
 
      * MISFIT: the objective function stores a float value
@@ -13,7 +13,7 @@ class RunType(Enum):
     PATH = 2
 
 
-class LookupState(Enum):
+class LookupState(IntEnum):
     """the state of the parameter set
 
      * PROVISIONAL: new entry under consideration
@@ -11,3 +11,20 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         f'sqlite:///{basedir}/app.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # raise on unexpected lazy loads while serialising listings
+    SQLALCHEMY_RAISELOAD = os.environ.get(
+        'SQLALCHEMY_RAISELOAD', '').lower() in ('1', 'true', 'yes')
+    # work factor of the argon2 password hashes
+    ARGON2_TIME_COST = int(os.environ.get('ARGON2_TIME_COST', 2))
+    ARGON2_MEMORY_COST = int(os.environ.get('ARGON2_MEMORY_COST', 46 * 1024))
+    # compress larger JSON responses
+    COMPRESS_MIMETYPES = ['application/json']
+    COMPRESS_LEVEL = 5
+    COMPRESS_MIN_SIZE = 1024
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_pre_ping': True}
+    if not SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        # keep a pool of warm connections to database servers
+        SQLALCHEMY_ENGINE_OPTIONS.update({
+            'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 10)),
+            'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 20)),
+            'pool_recycle': 1800})
@@ -0,0 +1,23 @@
+# gunicorn configuration for serving the objective function server
+#
+#   gunicorn -c python:ObjectiveFunction_server.gunicorn_config \
+#       ObjectiveFunction_server:app
+#
+# the configuration is loaded from the installed package, so the command
+# works from any directory
+#
+# the database drivers and the argon2 password hashes are blocking C calls
+# that would stall every greenlet of an async worker, so the workers are
+# threaded. Each worker runs as many threads as the database connection pool
+# holds connections, see DATABASE_POOL_SIZE.
+
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS',
+                             os.environ.get('DATABASE_POOL_SIZE', 10)))
+keepalive = int(os.environ.get('KEEPALIVE', 30))
@@ -0,0 +1,35 @@
+__all__ = ['json_response', 'request_json']
+
+from flask import Response, request, abort
+import orjson
+
+
+def json_response(data, status=200, conditional=False):
+    """create a JSON response encoded with orjson
+
+    :param data: the object to be serialised
+    :param status: the HTTP status code of the response
+    :param conditional: when True tag the response with an ETag and answer
+                        requests with a matching If-None-Match with 304,
+                        clients have to revalidate cached copies
+    """
+    response = Response(orjson.dumps(data), status=status,
+                        mimetype='application/json')
+    if conditional:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
+def request_json():
+    """decode the JSON body of the current request with orjson
+
+    :return: the decoded object
+    :status 400: when the body is not valid JSON
+    """
+    try:
+        return orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        abort(400, 'invalid json')
@@ -1,68 +1,178 @@
 from .application import db, app
-from itsdangerous import JSONWebSignatureSerializer as Serializer, BadSignature
-from passlib.apps import custom_app_context as pwd_context
+from itsdangerous import URLSafeSerializer, BadSignature
+from passlib.context import CryptContext
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.orm.collections import attribute_mapped_collection
+from functools import lru_cache
 import logging
-import pandas
 
 from .common import RunType, LookupState
 
 
+@lru_cache(maxsize=None)
+def _get_pwd_context(time_cost, memory_cost):
+    """get the context used to hash and verify passwords
+
+    :param time_cost: the number of argon2 iterations
+    :param memory_cost: the memory used by argon2 in KiB
+
+    New passwords are hashed with argon2id, hashes created with the older
+    sha512_crypt/sha256_crypt schemes or other argon2 settings are still
+    accepted and get upgraded the next time the password is verified.
+    """
+    return CryptContext(
+        schemes=['argon2', 'sha512_crypt', 'sha256_crypt'],
+        deprecated='auto',
+        argon2__type='ID',
+        argon2__memory_cost=memory_cost,
+        argon2__time_cost=time_cost,
+        argon2__parallelism=1)
+
+
+def pwd_context():
+    """get the password context for the configured work factor"""
+    return _get_pwd_context(app.config['ARGON2_TIME_COST'],
+                            app.config['ARGON2_MEMORY_COST'])
+
+
+@lru_cache(maxsize=None)
+def _get_serializer(secret_key):
+    """get the serializer used to sign authentication tokens
+
+    :param secret_key: the secret key used for signing
+    """
+    return URLSafeSerializer(secret_key)
+
+
+class IntEnumType(db.TypeDecorator):
+    """store an IntEnum as a small integer
+
+    :param enumtype: the IntEnum class used to convert the stored values
+    """
+    impl = db.SmallInteger
+    cache_ok = True
+
+    def __init__(self, enumtype, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.enumtype = enumtype
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            value = int(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = self.enumtype(value)
+        return value
+
+    def check_constraint(self, column, name):
+        """constraint limiting column to the values of the enum
+
+        :param column: the name of the column
+        :param name: the name of the constraint
+        """
+        return db.CheckConstraint(
+            f'{column} BETWEEN {min(self.enumtype).value} '
+            f'AND {max(self.enumtype).value}', name=name)
+
+
 class App(db.Model):
     __tablename__ = 'apps'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(32), index=True)
-    password_hash = db.Column(db.String(128))
+    password_hash = db.Column(db.String(256))
 
     def __repr__(self):
         return '<App {}>'.format(self.name)
 
     def hash_password(self, password):
-        if hasattr(pwd_context, 'hash'):
-            self.password_hash = pwd_context.hash(password)
-        else:
-            self.password_hash = pwd_context.encrypt(password)
+        self.password_hash = pwd_context().hash(password)
 
     def verify_password(self, password):
-        return pwd_context.verify(password, self.password_hash)
+        valid, new_hash = pwd_context().verify_and_update(
+            password, self.password_hash)
+        if valid and new_hash is not None:
+            # the stored hash uses an outdated scheme or settings
+            self.password_hash = new_hash
+            db.session.commit()
+        return valid
 
     def generate_auth_token(self):
-        s = Serializer(app.config['SECRET_KEY'])
+        s = _get_serializer(app.config['SECRET_KEY'])
         return s.dumps({'id': self.id})
 
     @staticmethod
     def verify_auth_token(token):
-        s = Serializer(app.config['SECRET_KEY'])
+        s = _get_serializer(app.config['SECRET_KEY'])
         try:
             data = s.loads(token)
         except BadSignature:
             return None  # invalid token
-        objfun_app = App.query.get(data['id'])
+        objfun_app = db.session.get(App, data['id'])
         return objfun_app
 
     def get_study(self, study):
-        study = Study.query.filter_by(name=study, app=self).one_or_none()
-        if not study:
+        # studies are unique per app, the cached statement
+        # becomes a probe of the unique index
+        app_id = self.id
+        stmt = db.lambda_stmt(
+            lambda: db.select(Study).where(Study.app_id == app_id,
+                                           Study.name == study))
+        db_study = db.session.execute(stmt).scalar_one_or_none()
+        if not db_study:
             raise LookupError(f'no study {study} for app {self.name}')
-        return study
+        return db_study
 
     def get_scenario(self, study, scenario):
-        study = self.get_study(study)
-        scenario = Scenario.query.filter_by(
-            name=scenario, study=study).one_or_none()
-        if not scenario:
+        # fetch the scenario together with its study in a single query
+        app_id = self.id
+        stmt = db.lambda_stmt(
+            lambda: db.select(Scenario).join(Scenario.study)
+            .where(Study.app_id == app_id, Study.name == study,
+                   Scenario.name == scenario)
+            .options(db.contains_eager(Scenario.study)))
+        db_scenario = db.session.execute(stmt).scalar_one_or_none()
+        if not db_scenario:
             raise LookupError(f'no scenario {scenario} for study {study}'
                               f' for app {self.name}')
-        return scenario
+        return db_scenario
 
     def get_run(self, study, scenario, runid):
-        scenario = self.get_scenario(study, scenario)
-        run = scenario.get_run_by_id(runid)
+        # fetch the run together with its scenario and study in a single
+        # query, the study parameters and the run values are not needed
+        app_id = self.id
+        stmt = db.lambda_stmt(
+            lambda: db.select(_ALL_RUNS)
+            .join(_ALL_RUNS.scenario).join(Scenario.study)
+            .where(Study.app_id == app_id, Study.name == study,
+                   Scenario.name == scenario, _ALL_RUNS.id == runid)
+            .options(db.contains_eager(_ALL_RUNS.scenario)
+                     .contains_eager(Scenario.study)
+                     .lazyload(Study.parameters)))
+        run = db.session.execute(stmt).scalar_one_or_none()
         if run is None:
             raise LookupError(
                 f'no run with ID {runid} for scenario {scenario} '
                 f'of study {study}')
         return run
 
+    def set_run_state(self, study, scenario, runid, state):
+        # update the state of the run in place, the scenario is matched
+        # by a subquery so that the run does not need to be loaded
+        scenario_id = db.select(Scenario.id).join(Scenario.study) \
+            .where(Study.app_id == self.id, Study.name == study,
+                   Scenario.name == scenario).scalar_subquery()
+        result = db.session.execute(
+            db.update(Run)
+            .where(Run.id == runid, Run.scenario_id == scenario_id)
+            .values(state=state)
+            .execution_options(synchronize_session=False))
+        if result.rowcount == 0:
+            raise LookupError(
+                f'no run with ID {runid} for scenario {scenario} '
+                f'of study {study}')
+
     studies = db.relationship("Study", back_populates="app")
 
 
@@ -78,7 +188,7 @@ class Study(db.Model):
                                back_populates="study",
                                cascade="all, delete")
     parameters = db.relationship("Parameter", order_by="Parameter.name",
-                                 back_populates="study",
+                                 back_populates="study", lazy="selectin",
                                  cascade="all, delete")
     scenarios = db.relationship("Scenario", back_populates="study",
                                 cascade="all, delete")
@@ -92,7 +202,7 @@ class Study(db.Model):
             'id': self.id,
             'name': self.name,
             'app': self.app.name,
-            'num_scenarios': len(self.scenarios)}
+            'num_scenarios': self.num_scenarios}
 
     def add_parameter(self, name, parameter):
         if 'type' not in parameter:
@@ -140,7 +250,8 @@ class Parameter(db.Model):
 
     __mapper_args__ = {
         'polymorphic_identity': 'parameter',
-        'polymorphic_on': type}
+        'polymorphic_on': type,
+        'with_polymorphic': '*'}
 
 
 class ParameterInt(Parameter):
@@ -190,23 +301,23 @@ class Scenario(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
-    runtype = db.Column(db.Enum(RunType))
+    runtype = db.Column(IntEnumType(RunType))
     study_id = db.Column(db.Integer, db.ForeignKey('studies.id'))
 
     study = db.relationship("Study", back_populates="scenarios")
     runs = db.relationship("Run", back_populates="scenario",
                            cascade="all, delete")
 
-    __table_args__ = (db.UniqueConstraint('name', 'study_id',
-                                          name='_unique_scenarios'), )
+    __table_args__ = (
+        db.UniqueConstraint('name', 'study_id', name='_unique_scenarios'),
+        IntEnumType(RunType).check_constraint(
+            'runtype', '_check_scenarios_runtype'))
 
     @property
     def _Run(self):
-        if self.runtype == RunType.MISFIT:
-            return RunMisfit
-        elif self.runtype == RunType.PATH:
-            return RunPath
-        else:
+        try:
+            return _RUN_CLASSES[self.runtype]
+        except KeyError:
             raise ValueError(f'unknown runtype {self.runtype}')
 
     @property
@@ -214,7 +325,7 @@ class Scenario(db.Model):
         return {'study': self.study.name,
                 'name': self.name,
                 'runtype': self.runtype.name,
-                'num_runs': len(self.runs)}
+                'num_runs': self.num_runs}
 
     def get_run_by_id(self, runid):
         """get a run with a particular id
@@ -230,28 +341,33 @@ class Scenario(db.Model):
         :param parmeters: dictionary containing parameter values
         """
 
-        dbParams = {}
-        dbParams['runid'] = []
-        for p in self.study.parameters:
-            dbParams[p.name] = []
-        for run in self.runs:
-            dbParams['runid'].append(run.id)
-            for p in run.values:
-                dbParams[p.parameter.name].append(p.value)
-
-        # turn into pandas dataframe to query
-        dbParams = pandas.DataFrame(dbParams)
-        # construct query
-        query = []
+        # match the requested (parameter, value) pairs and keep the run
+        # which matches all of them. The statement is built in a lambda so
+        # that its compiled form is cached, only the bound values change.
+        scenario_id = self.id
+        int_pairs = []
+        float_pairs = []
         for p in self.study.parameters:
-            v = parameters[p.name]
-            query.append('({}=={})'.format(p.name, v))
-        query = ' & '.join(query)
-        runid = dbParams.query(query)
-        if len(runid) == 0:
+            if isinstance(p, ParameterFloat):
+                float_pairs.append((p.id, parameters[p.name]))
+            else:
+                int_pairs.append((p.id, parameters[p.name]))
+        num_params = len(int_pairs) + len(float_pairs)
+        stmt = db.lambda_stmt(
+            lambda: db.select(RunParameters.lid)
+            .join(Run, Run.id == RunParameters.lid)
+            .where(Run.scenario_id == scenario_id,
+                   db.or_(db.tuple_(RunParameters.pid,
+                                    RunParametersInt.value).in_(int_pairs),
+                          db.tuple_(RunParameters.pid,
+                                    RunParametersFloat.value).in_(
+                                        float_pairs)))
+            .group_by(RunParameters.lid)
+            .having(db.func.count(RunParameters.id) == num_params))
+        runid = db.session.execute(stmt).first()
+        if runid is None:
             raise LookupError("no entry for parameter set found")
-        runid = int(runid.runid.iloc[0])
-        return self.get_run_by_id(runid)
+        return self.get_run_by_id(runid[0])
 
     def lookup_run(self, parameters):
         """look up run with a particular parameter set
@@ -269,19 +385,20 @@ class Scenario(db.Model):
 
         if run is None:
             # check if we already have a provisional entry
-            run = self._Run.query.filter_by(
+            provisional = db.session.query(self._Run.id).filter_by(
                 scenario=self, state=LookupState.PROVISIONAL).first()
-            if run is not None:
+            if provisional is not None:
                 # we already have a provisional value
-                # delete the previous one and wait
+                # delete the previous one and wait, the database removes
+                # the values of the run
                 logging.info('remove provisional parameter set')
-                db.session.delete(run)
+                Run.query.filter_by(id=provisional.id).delete(
+                    synchronize_session=False)
                 db.session.commit()
                 return 'waiting'
 
             logging.info('new provisional parameter set')
-            run = self._Run(self, parameters)
-            run.state = LookupState.PROVISIONAL
+            run = self._Run(self, parameters, state=LookupState.PROVISIONAL)
             db.session.commit()
             return 'provisional'
         else:
@@ -308,7 +425,9 @@ class Scenario(db.Model):
         query = self._Run.query.filter_by(
             scenario=self, state=state)
         if new_state is not None:
-            query = query.with_for_update()
+            # concurrent clients moving runs on skip the rows locked by
+            # each other instead of waiting for them
+            query = query.with_for_update(skip_locked=True)
         run = query.first()
         if run is None:
             raise LookupError(f'no parameter set in state {state.name}')
@@ -325,23 +444,43 @@ class Run(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     scenario_id = db.Column(db.Integer, db.ForeignKey('scenarios.id'))
-    state = db.Column(db.Enum(LookupState))
+    state = db.Column(IntEnumType(LookupState))
     type = db.Column(db.String)
 
-    values = db.relationship("RunParameters", back_populates="_run",
-                             cascade="all, delete-orphan")
+    values = db.relationship(
+        "RunParameters", back_populates="_run",
+        collection_class=attribute_mapped_collection("parameter_name"),
+        cascade="all, delete-orphan", passive_deletes=True)
     scenario = db.relationship("Scenario", back_populates="runs")
 
+    __table_args__ = (
+        IntEnumType(LookupState).check_constraint(
+            'state', '_check_runs_state'),
+        # runs are looked up by state within a scenario
+        db.Index('ix_runs_scenario_id_state', 'scenario_id', 'state'))
+
     __mapper_args__ = {
         'polymorphic_identity': 'run',
         'polymorphic_on': type}
 
-    def __init__(self, scenario, parameters):
+    def __init__(self, scenario, parameters, state=None):
+        values = {}
+        for db_param in scenario.study.parameters:
+            cls = _RUN_PARAMETERS_CLASSES[type(db_param)]
+            values.setdefault(cls, []).append({
+                'pid': db_param.id,
+                'type': cls.__mapper__.polymorphic_identity,
+                'value': parameters[db_param.name]})
+
         self.scenario = scenario
-        for db_param in self.scenario.study.parameters:
-            RunParameters(
-                _run=self, parameter=db_param,
-                value=parameters[db_param.name])
+        self.state = state
+        # the run needs an ID before its values can be inserted in bulk
+        db.session.add(self)
+        db.session.flush()
+        for cls in values:
+            for v in values[cls]:
+                v['lid'] = self.id
+            db.session.bulk_insert_mappings(cls, values[cls])
 
     @property
     def to_dict(self):
@@ -350,16 +489,13 @@ class Run(db.Model):
 
     @property
     def values_to_dict(self):
-        values = {}
-        for v in self.values:
-            values[v.parameter.name] = v.value
-        return values
+        return {name: v.value for name, v in self.values.items()}
 
     def _set_value(self, value):
         raise NotImplementedError
 
     def set_value(self, value, force=False):
-        if (self.state.value > LookupState.CONFIGURED.value
+        if (self.state > LookupState.CONFIGURED
             and self.state != LookupState.COMPLETED) or force:  # noqa W503
             self._set_value(value)
             self.state = LookupState.COMPLETED
@@ -418,13 +554,72 @@ class RunPath(Run):
         return {'value': self.path}
 
 
+# map the run type of a scenario to the class used to store its runs
+_RUN_CLASSES = {
+    RunType.MISFIT: RunMisfit,
+    RunType.PATH: RunPath}
+
+# count the children with a subquery rather than loading the collections,
+# the counts are deferred so they are only queried when used
+Study.num_scenarios = db.column_property(
+    db.select(db.func.count(Scenario.id))
+    .where(Scenario.study_id == Study.id)
+    .correlate_except(Scenario).scalar_subquery(),
+    deferred=True)
+Scenario.num_runs = db.column_property(
+    db.select(db.func.count(Run.id))
+    .where(Run.scenario_id == Scenario.id)
+    .correlate_except(Run).scalar_subquery(),
+    deferred=True)
+
+
 class RunParameters(db.Model):
     __tablename__ = 'run_parameters'
 
     id = db.Column(db.Integer, primary_key=True)
-    lid = db.Column(db.Integer, db.ForeignKey('runs.id'))
-    pid = db.Column(db.Integer, db.ForeignKey('parameters.id'))
-    value = db.Column(db.Integer)
+    lid = db.Column(db.Integer, db.ForeignKey('runs.id', ondelete='CASCADE'))
+    pid = db.Column(db.Integer, db.ForeignKey('parameters.id',
+                                              ondelete='CASCADE'))
+    type = db.Column(db.String)
 
     _run = db.relationship("Run", back_populates="values")
-    parameter = db.relationship("Parameter")
+    parameter = db.relationship("Parameter", lazy="joined")
+    parameter_name = association_proxy("parameter", "name")
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'runparameters',
+        'polymorphic_on': type,
+        'with_polymorphic': '*'}
+
+
+class RunParametersInt(RunParameters):
+    value = db.Column('value_int', db.Integer)
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'runparametersint'}
+
+
+class RunParametersFloat(RunParameters):
+    value = db.Column('value_float', db.Float)
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'runparametersfloat'}
+
+
+# the values of a parameter are stored in the column matching its type
+_RUN_PARAMETERS_CLASSES = {
+    ParameterInt: RunParametersInt,
+    ParameterFloat: RunParametersFloat}
+
+db.Index('ix_run_parameters_lid_pid_value_int', RunParameters.lid,
+         RunParameters.pid, RunParametersInt.value)
+db.Index('ix_run_parameters_pid_value_int', RunParameters.pid,
+         RunParametersInt.value)
+db.Index('ix_run_parameters_lid_pid_value_float', RunParameters.lid,
+         RunParameters.pid, RunParametersFloat.value)
+db.Index('ix_run_parameters_pid_value_float', RunParameters.pid,
+         RunParametersFloat.value)
+
+
+# runs loaded together with the columns of their subclass
+_ALL_RUNS = db.with_polymorphic(Run, '*')
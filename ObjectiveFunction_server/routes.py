@@ -1,12 +1,29 @@
+import hashlib
+import hmac
 import logging
-
-from .application import app, db
-from flask_httpauth import HTTPBasicAuth
-from flask import jsonify, request, abort, g
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from .application import app, db, auth
+from flask import request, abort, g
+from sqlalchemy.exc import IntegrityError
+from .json_utils import json_response, request_json
 from .models import App, Study, Scenario, Run, ObsName
 from .common import RunType, LookupState
 
-auth = HTTPBasicAuth()
+# map run type and state names to run types and states
+RUNTYPES = dict(RunType.__members__)
+STATES = dict(LookupState.__members__)
+
+# successfully verified passwords are remembered so that repeat requests
+# do not pay for the password hash again. Only a keyed digest of the
+# password is stored, the key is created per process.
+PASSWORD_CACHE_SIZE = 1024
+_password_cache_key = os.urandom(32)
+_password_cache = OrderedDict()
+_password_cache_lock = threading.Lock()
 
 
 def check_json(data, required_keys=[]):
@@ -24,14 +41,103 @@ def check_json(data, required_keys=[]):
     return data
 
 
+def parse_state(name):
+    """look up a run state by its name
+
+    :param name: the name of the state
+    :status 400: when there is no such state
+    """
+    state = STATES.get(name)
+    if state is None:
+        msg = f'unkown state {name}'
+        logging.error(msg)
+        abort(400, msg)
+    return state
+
+
+def require_json(*required_keys):
+    """decorator checking the JSON body of a request
+
+    The decoded body is passed to the view as its first argument.
+
+    :param required_keys: keys that must be present in the JSON object
+    :status 400: when the body is missing or a key is missing
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            try:
+                data = check_json(request_json(), required_keys)
+            except RuntimeError as e:
+                abort(400, str(e))
+            return f(data, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def listing_options(*options):
+    """loader options for the rows of a listing
+
+    When SQLALCHEMY_RAISELOAD is set, accessing a relationship that is not
+    covered by the options and would emit SQL raises an error instead.
+
+    :param options: the loader options needed to serialise the rows
+    """
+    if app.config['SQLALCHEMY_RAISELOAD']:
+        options += (db.raiseload('*', sql_only=True), )
+    return options
+
+
+def check_password(objfun_app, password):
+    """check the password of an app
+
+    :param objfun_app: the app to be checked
+    :param password: the password to check
+
+    The result of successful checks is cached. The cache is keyed on the
+    stored password hash so that it does not outlive a password change.
+    """
+    digest = hmac.new(_password_cache_key, password.encode('utf-8'),
+                      hashlib.sha256).digest()
+    key = (objfun_app.id, objfun_app.password_hash, digest)
+    with _password_cache_lock:
+        if key in _password_cache:
+            _password_cache.move_to_end(key)
+            return True
+    if not objfun_app.verify_password(password):
+        return False
+    # the hash may have been upgraded during verification
+    key = (objfun_app.id, objfun_app.password_hash, digest)
+    with _password_cache_lock:
+        _password_cache[key] = True
+        if len(_password_cache) > PASSWORD_CACHE_SIZE:
+            _password_cache.popitem(last=False)
+    return True
+
+
+@app.before_request
+def check_content_type():
+    """reject POST and PUT requests to the API without a JSON body
+
+    this runs before the authentication so that such requests do not cause
+    password checks, unknown paths are left to the 404 handler
+    """
+    if request.method in ('POST', 'PUT') and request.url_rule is not None \
+       and not request.is_json:
+        abort(415, 'expected a JSON request body')
+
+
 @auth.verify_password
 def verify_password(name_or_token, password):
-    # first try to authenticate by token
-    objfun_app = App.verify_auth_token(name_or_token)
+    # first try to authenticate by token, tokens always contain the '.'
+    # separating the payload from the signature
+    objfun_app = None
+    if '.' in name_or_token:
+        objfun_app = App.verify_auth_token(name_or_token)
     if not objfun_app:
         # try to authenticate with name/password
         objfun_app = App.query.filter_by(name=name_or_token).first()
-        if not objfun_app or not objfun_app.verify_password(password):
+        if not objfun_app or not check_password(objfun_app, password):
             return False
     g.objfun_app = objfun_app
     return True
@@ -46,8 +152,7 @@ def get_auth_token():
 
     :>json string token: the authentication token
     """
-    token = g.objfun_app.generate_auth_token()
-    return jsonify({'token': token.decode('ascii')})
+    return json_response({'token': g.objfun_app.generate_auth_token()})
 
 
 @app.route('/api/studies', methods=['GET'])
@@ -63,15 +168,20 @@ def get_all_studies():
     :>jsonarr int num_scenarios: the number of scenarios associated
                                  with this study
     """
-    results = []
-    for study in g.objfun_app.studies:
-        results.append(study.to_dict)
-    return jsonify({'data': results}), 200
+    # load the scenario counts with the studies, the parameters
+    # are not needed
+    studies = Study.query.filter_by(app=g.objfun_app) \
+        .options(*listing_options(db.undefer(Study.num_scenarios),
+                                  db.lazyload(Study.parameters))) \
+        .order_by(Study.id)
+    return json_response({'data': [study.to_dict for study in studies]},
+                         conditional=True)
 
 
 @app.route('/api/create_study', methods=['POST'])
 @auth.login_required
-def create_study():
+@require_json('name', 'parameters')
+def create_study(data):
     """create a new study
 
     .. :quickref: create_study; create a new study
@@ -84,14 +194,10 @@ def create_study():
     :>json int num_scenarios: the number of scenarios associated
                                  with this study
     :status 400: when name or parameters is missing
+    :status 415: when the request body is not JSON
     :status 409: when study already exists
     :status 201: study was successfully created
     """
-    try:
-        data = check_json(request.get_json(), ['name', 'parameters'])
-    except RuntimeError as e:
-        abort(400, str(e))
-
     study = Study(name=data['name'], app=g.objfun_app)
     for pname in data['parameters']:
         try:
@@ -102,7 +208,7 @@ def create_study():
     db.session.add(study)
     db.session.commit()
 
-    return jsonify(study.to_dict), 201
+    return json_response(study.to_dict, 201)
 
 
 @app.route('/api/studies/<string:name>', methods=['GET', 'DELETE'])
@@ -141,12 +247,11 @@ def get_study(name):
         abort(404, str(e))
 
     if request.method == 'GET':
-        res = jsonify(study.to_dict)
+        return json_response(study.to_dict, conditional=True)
     elif request.method == 'DELETE':
         db.session.delete(study)
         db.session.commit()
-        res = ''
-    return res, 200
+        return '', 200
 
 
 @app.route('/api/studies/<string:name>/parameters', methods=['GET'])
@@ -167,16 +272,15 @@ def get_study_params(name):
         logging.error(e)
         abort(404, str(e))
 
-    params = {}
-    for p in study.parameters:
-        params[p.name] = p.to_dict
+    params = {p.name: p.to_dict for p in study.parameters}
 
-    return jsonify(params), 200
+    return json_response(params, conditional=True)
 
 
 @app.route('/api/studies/<string:study>/create_scenario', methods=['POST'])
 @auth.login_required
-def create_scenario(study):
+@require_json('name', 'runtype')
+def create_scenario(data, study):
     """create a new scenario
 
     .. :quickref: studies; create a new scenario for study
@@ -187,18 +291,13 @@ def create_scenario(study):
     :<json string name: the name of the scenario
     :<json string runtype: the type of scenrio, must be one of 'MISFIT', 'PATH'
     :status 400: when name or runtype is missing
+    :status 415: when the request body is not JSON
     :status 404: when the study does not exist
     :status 409: when scenario already exists
     :status 201: the scenario was successfully created
     """
-    try:
-        data = check_json(request.get_json(), ['name', 'runtype'])
-    except RuntimeError as e:
-        abort(400, str(e))
-
-    try:
-        runtype = RunType.__members__[data['runtype']]
-    except KeyError:
+    runtype = RUNTYPES.get(data['runtype'])
+    if runtype is None:
         msg = f'wrong run type {data["runtype"]}'
         logging.error(msg)
         abort(400, msg)
@@ -209,18 +308,17 @@ def create_scenario(study):
         logging.error(e)
         abort(404, str(e))
 
-    # check if scenario already exists
-    scenario = Scenario.query.filter_by(
-        study=study, name=data['name']).one_or_none()
-    if scenario:
+    # the unique constraint on the scenario name catches existing scenarios
+    scenario = Scenario(study=study, name=data['name'], runtype=runtype)
+    db.session.add(scenario)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
         msg = f'scenario {data["name"]} already exists'
         logging.warning(msg)
         abort(409, msg)
 
-    scenario = Scenario(study=study, name=data['name'], runtype=runtype)
-    db.session.add(scenario)
-    db.session.commit()
-
     return '', 201
 
 
@@ -237,7 +335,8 @@ def observation_names(study):
 
     :status 404: when the study does not exist or the observation names do
                  not match
-    :status 200: list of observation names
+    :status 415: when the body of a PUT request is not JSON
+    :status 200: list of observation names or the observation names match
     :status 201: observation names were successfully added
     """
     try:
@@ -247,34 +346,37 @@ def observation_names(study):
         abort(404, str(e))
 
     if request.method == 'GET':
-        obsnames = []
-        for o in study.obsnames:
-            obsnames.append(o.name)
-        return jsonify({'obsnames': obsnames}), 200
+        obsnames = [o.name for o in study.obsnames]
+        return json_response({'obsnames': obsnames}, conditional=True)
     elif request.method == 'PUT':
         try:
-            data = check_json(request.get_json(), ['obsnames'])
+            data = check_json(request_json(), ['obsnames'])
         except RuntimeError as e:
             abort(400, str(e))
         obsnames = data['obsnames']
-        if len(study.obsnames) > 0:
+        # only the names of the stored observations are needed
+        existing = {name for name, in db.session.query(ObsName.name)
+                    .filter_by(study_id=study.id)}
+        if existing:
             # check names
-            if len(obsnames) != len(study.obsnames):
+            if len(obsnames) != len(existing):
                 msg = 'number of observation names does not match'
                 logging.error(msg)
                 abort(404, msg)
-            error = False
-            for o in study.obsnames:
-                if o.name not in obsnames:
-                    logging.error(f'{o.name} missing')
-                    error = True
-            if error:
+            missing = existing.difference(obsnames)
+            if missing:
+                for name in sorted(missing):
+                    logging.error('%s missing', name)
                 msg = 'observation names do not match'
                 logging.error(msg)
                 abort(404, msg)
+            return '', 200
         else:
-            for o in obsnames:
-                db.session.add(ObsName(name=o, study=study))
+            # insert all names with a single statement
+            if obsnames:
+                db.session.execute(
+                    ObsName.__table__.insert(),
+                    [{'name': o, 'study_id': study.id} for o in obsnames])
             db.session.commit()
             return '', 201
 
@@ -299,10 +401,11 @@ def get_all_scenarios(study):
         logging.error(e)
         abort(404, str(e))
 
-    results = []
-    for scenario in study.scenarios:
-        results.append(scenario.to_dict)
-    return jsonify({'data': results}), 200
+    scenarios = Scenario.query.filter_by(study=study) \
+        .options(*listing_options(db.undefer(Scenario.num_runs))) \
+        .order_by(Scenario.id)
+    return json_response({'data': [s.to_dict for s in scenarios]},
+                         conditional=True)
 
 
 @app.route('/api/studies/<string:study>/scenarios/<string:name>',
@@ -355,16 +458,20 @@ def get_all_runs(study, name):
         logging.error(e)
         abort(404, str(e))
 
-    results = []
-    for run in scenario.runs:
-        results.append(run.to_dict)
-    return jsonify({'data': results}), 200
+    # query the run class of the scenario so that the run values are
+    # loaded with the runs
+    runs = scenario._Run.query.filter_by(scenario=scenario) \
+        .options(*listing_options()) \
+        .order_by(Run.id)
+    return json_response({'data': [run.to_dict for run in runs]},
+                         conditional=True)
 
 
 @app.route('/api/studies/<string:study>/scenarios/<string:name>/get_run',
            methods=['POST'])
 @auth.login_required
-def get_run_by_params(study, name):
+@require_json('parameters')
+def get_run_by_params(data, study, name):
     """get a run of a particular scenario
 
     .. :quickref: scenarios; get information about a particular run
@@ -374,14 +481,10 @@ def get_run_by_params(study, name):
     :param name: name of the scenario
     :type name: string
     :status 400: when name or runtype is missing
+    :status 415: when the request body is not JSON
     :status 404: when the scenario does not exist
     :status 201: the call successfully returned a json string
     """
-
-    try:
-        data = check_json(request.get_json(), ['parameters'])
-    except RuntimeError as e:
-        abort(400, str(e))
     data = data['parameters']
 
     try:
@@ -395,12 +498,14 @@ def get_run_by_params(study, name):
     except LookupError:
         abort(404, 'no such run')
 
-    return jsonify(run.to_dict), 201
+    return json_response(run.to_dict, 201)
+
 
 @app.route('/api/studies/<string:study>/scenarios/<string:name>/lookup_run',
            methods=['POST'])
 @auth.login_required
-def lookup_run(study, name):
+@require_json('parameters')
+def lookup_run(data, study, name):
     """lookup a run of a particular scenario
 
     .. :quickref: scenarios; lookup run
@@ -410,14 +515,10 @@ def lookup_run(study, name):
     :param name: name of the scenario
     :type name: string
     :status 400: when name or runtype is missing
+    :status 415: when the request body is not JSON
     :status 404: when the scenario does not exist
     :status 201: the call successfully returned a json string
     """
-
-    try:
-        data = check_json(request.get_json(), ['parameters'])
-    except RuntimeError as e:
-        abort(400, str(e))
     data = data['parameters']
 
     try:
@@ -431,14 +532,15 @@ def lookup_run(study, name):
         result = run.to_dict
     else:
         result = {'status': run}
-    return jsonify(result), 201
+    return json_response(result, 201)
 
 
 @app.route(
     '/api/studies/<string:study>/scenarios/<string:name>/runs/with_state',
     methods=['POST'])
 @auth.login_required
-def get_run_with_state(study, name):  # noqa: 318
+@require_json('state')
+def get_run_with_state(data, study, name):  # noqa: 318
     """get run in a particular state
 
     .. :quickref: runs; get run in particular state
@@ -450,28 +552,14 @@ def get_run_with_state(study, name):  # noqa: 318
     :<json string state: the state the run should be in
     :<json string new_state: optionally, the new state the run will move to
     :status 400: when name or runtype is missing
+    :status 415: when the request body is not JSON
     :status 404: when the scenario does not exist
     :status 201: the call successfully returned a json string
     """
-    try:
-        data = check_json(request.get_json(), ['state'])
-    except RuntimeError as e:
-        abort(400, str(e))
-
-    try:
-        state = LookupState.__members__[data['state']]
-    except KeyError:
-        msg = f'unkown state {data["state"]}'
-        logging.error(msg)
-        abort(400, msg)
+    state = parse_state(data['state'])
     new_state = None
     if 'new_state' in data:
-        try:
-            new_state = LookupState.__members__[data['new_state']]
-        except KeyError:
-            msg = f'unkown state {data["new_state"]}'
-            logging.error(msg)
-            abort(400, msg)
+        new_state = parse_state(data['new_state'])
 
     try:
         scenario = g.objfun_app.get_scenario(study, name)
@@ -488,7 +576,7 @@ def get_run_with_state(study, name):  # noqa: 318
     result = run.to_dict
     result['values'] = run.values_to_dict
 
-    return jsonify(result), 201
+    return json_response(result, 201)
 
 
 @app.route(
@@ -515,7 +603,7 @@ def get_run_by_id(study, name, runid):
         logging.error(e)
         abort(404, str(e))
 
-    return jsonify(run.to_dict), 200
+    return json_response(run.to_dict, conditional=True)
 
 
 @app.route(
@@ -535,27 +623,27 @@ def run_state(study, name, runid):
     :param id: the run ID
     :type id: int
     :status 404: when the run does not exist
+    :status 415: when the body of a PUT request is not JSON
     """
-    try:
-        run = g.objfun_app.get_run(study, name, runid)
-    except LookupError as e:
-        logging.error(e)
-        abort(404, str(e))
-
     if request.method == 'GET':
-        return jsonify({'state': run.state.name}), 200
+        try:
+            run = g.objfun_app.get_run(study, name, runid)
+        except LookupError as e:
+            logging.error(e)
+            abort(404, str(e))
+        return json_response({'state': run.state.name}, conditional=True)
     elif request.method == 'PUT':
         try:
-            data = check_json(request.get_json(), ['state'])
+            data = check_json(request_json(), ['state'])
         except RuntimeError as e:
             abort(400, str(e))
+        state = parse_state(data['state'])
+        # the run is updated without loading it first
         try:
-            state = LookupState.__members__[data['state']]
-        except KeyError:
-            msg = f'unkown state {data["state"]}'
-            logging.error(msg)
-            abort(400, msg)
-        run.state = state
+            g.objfun_app.set_run_state(study, name, runid, state)
+        except LookupError as e:
+            logging.error(e)
+            abort(404, str(e))
         db.session.commit()
         return '', 201
 
@@ -577,6 +665,7 @@ def run_value(study, name, runid):  # noqa: C901
     :param id: the run ID
     :type id: int
     :status 404: when the run does not exist
+    :status 415: when the body of a PUT request is not JSON
     """
     try:
         run = g.objfun_app.get_run(study, name, runid)
@@ -585,10 +674,10 @@ def run_value(study, name, runid):  # noqa: C901
         abort(404, str(e))
 
     if request.method == 'GET':
-        return jsonify(run.get_value()), 200
+        return json_response(run.get_value(), conditional=True)
     elif request.method == 'PUT':
         try:
-            data = check_json(request.get_json())
+            data = check_json(request_json())
         except RuntimeError as e:
             abort(400, str(e))
         force = False
@@ -12,13 +12,16 @@ setup(
     version=release,
     include_package_data=True,
     install_requires=[
-        "sqlalchemy",
-        "flask>=1.0",
-        "flask_sqlalchemy",
-        "itsdangerous",
-        "passlib",
+        "sqlalchemy>=1.4,<2.0",
+        "flask>=1.0,<2",
+        "flask_sqlalchemy<3",
+        "itsdangerous<2.0",
+        "markupsafe<2.1",
+        "jinja2<3",
+        "passlib[argon2]>=1.7",
         "flask-httpauth",
-        "pandas",
+        "flask-compress",
+        "orjson",
     ],
     cmdclass={'build_sphinx': BuildDoc},
     command_options={
@@ -30,6 +33,9 @@ setup(
             'source_dir': ('setup.py', 'docs')}},
     setup_requires=['sphinx'],
     extras_require={
+        'server': [
+            'gunicorn',
+        ],
         'docs': [
             'sphinx<4.0',
             'sphinx_rtd_theme',
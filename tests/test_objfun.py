@@ -1,12 +1,15 @@
 from flask_testing import TestCase as FlaskTestCase
 from unittest import TestCase
+from contextlib import contextmanager
+from passlib.hash import sha512_crypt
+from sqlalchemy import event
 import base64
 
 from ObjectiveFunction_server import app, db
 from ObjectiveFunction_server.models import App, Study, Scenario, ObsName
-from ObjectiveFunction_server.models import RunMisfit, RunPath
+from ObjectiveFunction_server.models import RunMisfit, RunPath, RunParameters
 from ObjectiveFunction_server.common import RunType, LookupState
-from ObjectiveFunction_server.routes import check_json
+from ObjectiveFunction_server.routes import check_json, check_password
 
 # test data
 app_name = 'test'
@@ -24,10 +27,29 @@ scenario_misfit_name = 'scenario misfit'
 scenario_path_name = 'scenario path'
 run_misfit = ({'paramA': 0, 'paramB': 50}, 10.)
 run_path = ({'paramA': 0, 'paramB': 50}, '/some/path')
+scenario_misfit_url = f'/api/studies/{study_name}/scenarios/' \
+    f'{scenario_misfit_name}'
 
-headers = {}
-headers['Authorization'] = 'Basic ' + base64.b64encode(
-    (app_name + ':' + passwd).encode('utf-8')).decode('utf-8')
+# test configuration
+app.config['TESTING'] = True
+app.config['WTF_CSRF_ENABLED'] = False
+app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+# fail on lazy loads in listings
+app.config['SQLALCHEMY_RAISELOAD'] = True
+# cheap password hashes
+app.config['ARGON2_TIME_COST'] = 1
+app.config['ARGON2_MEMORY_COST'] = 8
+
+
+def basic_auth(username, password):
+    """the value of a basic authorization header"""
+    return 'Basic ' + base64.b64encode(
+        (username + ':' + password).encode('utf-8')).decode('utf-8')
+
+
+# a plain dict, the test client copies it into a fresh Headers object for
+# every request
+headers = {'Authorization': basic_auth(app_name, passwd)}
 
 
 class CheckJson(TestCase):
@@ -43,23 +65,27 @@ class CheckJson(TestCase):
 class ObjFunBase(FlaskTestCase):
 
     def create_app(self):
-        app.config['TESTING'] = True
-        app.config['WTF_CSRF_ENABLED'] = False
-        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
-
-        # pass in test configuration
+        # the test configuration is applied once at import
         return app
 
+    # the schema is created once per test class and emptied after each test
+    schema_created = False
+
     def setUp(self):
-        self.app = app.test_client()
+        # use the test client set up by flask_testing
+        self.app = self.client
 
-        db.create_all()
+        if not type(self).schema_created:
+            db.create_all()
+            type(self).schema_created = True
         # create app
         a = App(name=app_name)
         a.hash_password(passwd)
         db.session.add(a)
+        # keep the app around rather than looking it up in every test
+        self.app_obj = a
         # create study
-        st = Study(name=study_name, app=self.get_app())
+        st = Study(name=study_name, app=a)
         # and some parameters
         for p in test_parameters:
             st.add_parameter(p, test_parameters[p])
@@ -70,11 +96,32 @@ class ObjFunBase(FlaskTestCase):
 
     def tearDown(self):
         db.session.remove()
-        db.drop_all()
-
-    def get_app(self):
-        app = App.query.filter_by(name=app_name).first()
-        return app
+        with db.engine.begin() as connection:
+            for table in reversed(db.metadata.sorted_tables):
+                connection.execute(table.delete())
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.schema_created:
+            db.drop_all()
+            cls.schema_created = False
+        super().tearDownClass()
+
+    @contextmanager
+    def count_queries(self):
+        """collect the SQL statements executed within the context"""
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            yield queries
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
 
 
 class ObjFunModel(ObjFunBase):
@@ -88,16 +135,23 @@ class ObjFunModel(ObjFunBase):
         self.assertFalse(a.verify_password(p + 'not'))
 
         db.session.add(a)
-        db.session.commit()
+        db.session.flush()
 
         assert a in db.session
 
+    def test_app_upgrade_password_hash(self):
+        a = self.app_obj
+        a.password_hash = sha512_crypt.using(rounds=1000).hash(passwd)
+        self.assertTrue(a.verify_password(passwd))
+        self.assertTrue(a.password_hash.startswith('$argon2id$'))
+        self.assertTrue(a.verify_password(passwd))
+
     def test_get_study_fail(self):
         with self.assertRaises(LookupError):
-            self.get_app().get_study(study_name + 'fail')
+            self.app_obj.get_study(study_name + 'fail')
 
     def test_get_study(self):
-        study = self.get_app().get_study(study_name)
+        study = self.app_obj.get_study(study_name)
         self.assertEqual(
             study.to_dict,
             {'id': study.id,
@@ -106,7 +160,7 @@ class ObjFunModel(ObjFunBase):
              'num_scenarios': 2})
 
     def test_add_parameter_fail(self):
-        st = Study(name='test', app=self.get_app())
+        st = Study(name='test', app=self.app_obj)
         # no parameter type
         with self.assertRaises(RuntimeError):
             st.add_parameter('test_p', {})
@@ -115,34 +169,34 @@ class ObjFunModel(ObjFunBase):
             st.add_parameter('test_p', {'type': 'wrong'})
 
     def test_add_parameter_int(self):
-        st = Study(name='test', app=self.get_app())
+        st = Study(name='test', app=self.app_obj)
         param = st.add_parameter('test_p', param_int)
         self.assertEqual(param.to_dict, param_int)
 
     def test_add_parameter_float(self):
-        st = Study(name='test', app=self.get_app())
+        st = Study(name='test', app=self.app_obj)
         param = st.add_parameter('test_p', param_float)
         self.assertEqual(param.to_dict, param_float)
 
     def test_obsname(self):
         obsname = 'obs_test'
-        st = Study(name='test', app=self.get_app())
+        st = Study(name='test', app=self.app_obj)
         obs = ObsName(name=obsname, study=st)
         self.assertEqual(obs.name, obsname)
         self.assertEqual(obs.study, st)
 
     def test_get_scenario_fail_no_scenario(self):
         with self.assertRaises(LookupError):
-            self.get_app().get_scenario(
+            self.app_obj.get_scenario(
                 study_name, scenario_misfit_name + 'fail')
 
     def test_scenario(self):
-        scenario = self.get_app().get_scenario(
+        scenario = self.app_obj.get_scenario(
             study_name, scenario_misfit_name)
         self.assertEqual(scenario.name, scenario_misfit_name)
 
     def test_scenario_dict(self):
-        scenario = self.get_app().get_scenario(
+        scenario = self.app_obj.get_scenario(
             study_name, scenario_misfit_name)
         self.assertEqual(
             scenario.to_dict,
@@ -151,17 +205,39 @@ class ObjFunModel(ObjFunBase):
              'runtype': RunType.MISFIT.name,
              'num_runs': 0})
 
+    def test_get_run(self):
+        scenario = self.app_obj.get_scenario(
+            study_name, scenario_misfit_name)
+        params = {'paramA': 1, 'paramB': 50}
+        run1 = RunMisfit(scenario, run_misfit[0])
+        run2 = RunMisfit(scenario, params)
+        self.assertEqual(scenario.get_run(run_misfit[0]), run1)
+        self.assertEqual(scenario.get_run(params), run2)
+        with self.assertRaises(LookupError):
+            scenario.get_run({'paramA': 1, 'paramB': 20})
+
+    def test_get_run_float(self):
+        scenario = self.app_obj.get_scenario(
+            study_name, scenario_misfit_name)
+        params = {'paramA': 0.3, 'paramB': 50}
+        run = RunMisfit(scenario, params)
+        self.assertEqual(run.values_to_dict, params)
+        self.assertEqual(scenario.get_run(params), run)
+        with self.assertRaises(LookupError):
+            scenario.get_run({'paramA': 0.2, 'paramB': 50})
+
     def check_run(self, runObj, data):
-        scenario = self.get_app().get_scenario(
+        scenario = self.app_obj.get_scenario(
             study_name, scenario_misfit_name)
         run = runObj(scenario, data[0])
         self.assertEqual(run.values_to_dict, data[0])
 
         # these should fail because run is in wrong state
         for state in [LookupState.NEW, LookupState.COMPLETED]:
-            run.state = state
-            with self.assertRaises(RuntimeError):
-                run.set_value(data[1])
+            with self.subTest(state=state):
+                run.state = state
+                with self.assertRaises(RuntimeError):
+                    run.set_value(data[1])
         # set state to ACTIVE
         run.state = LookupState.ACTIVE
         run.set_value({'value': data[1]})
@@ -181,6 +257,17 @@ class ObjFunModel(ObjFunBase):
     def test_run_path(self):
         self.check_run(RunPath, run_path)
 
+    def test_check_password(self):
+        a = self.app_obj
+        self.assertTrue(check_password(a, passwd))
+        # cached
+        self.assertTrue(check_password(a, passwd))
+        self.assertFalse(check_password(a, passwd + 'not'))
+        # changing the password invalidates the cache
+        a.hash_password(passwd + 'new')
+        self.assertFalse(check_password(a, passwd))
+        self.assertTrue(check_password(a, passwd + 'new'))
+
 
 class ObjFunRoutes(ObjFunBase):
 
@@ -192,15 +279,37 @@ class ObjFunRoutes(ObjFunBase):
         response = self.app.get('/api/token', headers=headers)
         token = response.get_json()['token']
 
-        h = {}
-        h['Authorization'] = 'Basic ' + base64.b64encode(
-            token.encode('utf-8') + b': ').decode('utf-8')
-        h['Content-Type'] = 'application/json'
-        h['Accept'] = 'application/json'
+        h = {'Authorization': basic_auth(token, ' '),
+             'Content-Type': 'application/json',
+             'Accept': 'application/json'}
 
         response = self.app.get('/api/token', headers=h)
         self.assertEqual(response.status_code, 200)
 
+    def test_auth_with_dotted_name(self):
+        # names containing a '.' fall through to the password check
+        a = App(name='test.app')
+        a.hash_password(passwd)
+        db.session.add(a)
+        db.session.commit()
+        response = self.app.get(
+            '/api/token',
+            headers={'Authorization': basic_auth('test.app', passwd)})
+        self.assertEqual(response.status_code, 200)
+        response = self.app.get(
+            '/api/token',
+            headers={'Authorization': basic_auth('test.app', 'wrong')})
+        self.assertEqual(response.status_code, 401)
+
+    def test_auth_fail_token_as_password(self):
+        # tokens are only accepted in place of the name
+        response = self.app.get('/api/token', headers=headers)
+        token = response.get_json()['token']
+        response = self.app.get(
+            '/api/token',
+            headers={'Authorization': basic_auth(app_name, token)})
+        self.assertEqual(response.status_code, 401)
+
     def test_get_all_studies(self):
         response = self.app.get('/api/studies', headers=headers)
         self.assertEqual(response.status_code, 200)
@@ -210,11 +319,51 @@ class ObjFunRoutes(ObjFunBase):
                                       'app': app_name,
                                       'num_scenarios': 2}]})
 
+    def test_get_all_studies_not_modified(self):
+        response = self.app.get('/api/studies', headers=headers)
+        etag = response.headers['ETag']
+        response = self.app.get(
+            '/api/studies', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        # the tag changes with the data
+        Scenario(name='new scenario', runtype=RunType.PATH,
+                 study=self.app_obj.get_study(study_name))
+        db.session.commit()
+        response = self.app.get(
+            '/api/studies', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['data'][0]['num_scenarios'], 3)
+
     def test_create_study_fail(self):
         response = self.app.post(
             '/api/create_study', json={}, headers=headers)
         self.assertEqual(response.status_code, 400)
 
+    def test_create_study_fail_invalid_json(self):
+        response = self.app.post(
+            '/api/create_study', data='{"name": ',
+            content_type='application/json', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_create_study_fail_content_type(self):
+        response = self.app.post(
+            '/api/create_study', data='name', headers=headers)
+        self.assertEqual(response.status_code, 415)
+
+    def test_create_study_fail_content_type_no_auth(self):
+        # the content type is checked before the credentials
+        response = self.app.post('/api/create_study', data='name')
+        self.assertEqual(response.status_code, 415)
+
+    def test_create_study_fail_no_auth(self):
+        response = self.app.post('/api/create_study', json={'name': 'x'})
+        self.assertEqual(response.status_code, 401)
+
+    def test_post_fail_no_such_route(self):
+        response = self.app.post(
+            '/api/no_such_route', data='name', headers=headers)
+        self.assertEqual(response.status_code, 404)
+
     def test_create_study_fail_parameter(self):
         params = dict(test_parameters)
         params['paramC'] = {'type': 'wrong'}
@@ -250,6 +399,23 @@ class ObjFunRoutes(ObjFunBase):
                             'app': app_name,
                             'num_scenarios': 2})
 
+    def test_get_study_not_modified(self):
+        url = f'/api/studies/{study_name}'
+        response = self.app.get(url, headers=headers)
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        etag = response.headers['ETag']
+        response = self.app.get(
+            url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        # the tag changes with the study
+        Scenario(name='new scenario', runtype=RunType.PATH,
+                 study=self.app_obj.get_study(study_name))
+        db.session.commit()
+        response = self.app.get(
+            url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['num_scenarios'], 3)
+
     def test_get_study_params_fail_no_study(self):
         response = self.app.get(
             f'/api/studies/wrong_study/parameters', headers=headers)
@@ -271,23 +437,17 @@ class ObjFunRoutes(ObjFunBase):
             f'/api/studies/{study_name}', headers=headers)
         self.assertEqual(response.status_code, 200)
 
-    def test_create_scenario_fail_no_study(self):
-        response = self.app.post(
-            f'/api/studies/wrong_study/create_scenario',
-            json={'name': 'test', 'runtype': 'MISFIT'}, headers=headers)
-        self.assertEqual(response.status_code, 404)
-
-    def test_create_scenario_fail_wrong_json(self):
-        response = self.app.post(
-            f'/api/studies/{study_name}/create_scenario',
-            json={}, headers=headers)
-        self.assertEqual(response.status_code, 400)
-
-    def test_create_scenario_fail_wrong_runtype(self):
-        response = self.app.post(
-            f'/api/studies/{study_name}/create_scenario',
-            json={'name': 'test', 'runtype': 'wrong'}, headers=headers)
-        self.assertEqual(response.status_code, 400)
+    def test_create_scenario_fail(self):
+        for name, url, data, status in [
+                ('no_study', '/api/studies/wrong_study/create_scenario',
+                 {'name': 'test', 'runtype': 'MISFIT'}, 404),
+                ('wrong_json', f'/api/studies/{study_name}/create_scenario',
+                 {}, 400),
+                ('wrong_runtype', f'/api/studies/{study_name}/create_scenario',
+                 {'name': 'test', 'runtype': 'wrong'}, 400)]:
+            with self.subTest(name):
+                response = self.app.post(url, json=data, headers=headers)
+                self.assertEqual(response.status_code, status)
 
     def test_create_scenario_exists(self):
         response = self.app.post(
@@ -311,7 +471,7 @@ class ObjFunRoutes(ObjFunBase):
 
     def test_get_observation_names(self):
         obsname = 'obsA'
-        st = Study(name='test', app=self.get_app())
+        st = Study(name='test', app=self.app_obj)
         ObsName(name=obsname, study=st)
         db.session.commit()
         response = self.app.get(
@@ -329,7 +489,7 @@ class ObjFunRoutes(ObjFunBase):
 
     def test_put_observation_names_fail_wrong_num(self):
         obsname = 'obsA'
-        st = Study(name='test', app=self.get_app())
+        st = Study(name='test', app=self.app_obj)
         ObsName(name=obsname, study=st)
         db.session.commit()
         response = self.app.put(
@@ -340,7 +500,7 @@ class ObjFunRoutes(ObjFunBase):
 
     def test_put_observation_names_fail_wrong_obs(self):
         obsname = 'obsA'
-        st = Study(name='test', app=self.get_app())
+        st = Study(name='test', app=self.app_obj)
         ObsName(name=obsname, study=st)
         db.session.commit()
         response = self.app.put(
@@ -349,6 +509,17 @@ class ObjFunRoutes(ObjFunBase):
             headers=headers)
         self.assertEqual(response.status_code, 404)
 
+    def test_put_observation_names_existing(self):
+        st = Study(name='test', app=self.app_obj)
+        ObsName(name='obsA', study=st)
+        ObsName(name='obsB', study=st)
+        db.session.commit()
+        response = self.app.put(
+            '/api/studies/test/observation_names',
+            json={'obsnames': ['obsB', 'obsA']},
+            headers=headers)
+        self.assertEqual(response.status_code, 200)
+
     def test_put_observation_names(self):
         response = self.app.put(
             f'/api/studies/{study_name}/observation_names',
@@ -392,7 +563,7 @@ class ObjFunRoutes(ObjFunBase):
 
     def test_delete_scenario(self):
         response = self.app.delete(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}',
+            scenario_misfit_url,
             headers=headers)
         self.assertEqual(response.status_code, 200)
 
@@ -413,7 +584,7 @@ class ObjFunRoutesRuns(ObjFunBase):
 
     def setUp(self):
         super().setUp()
-        scenario = self.get_app().get_scenario(
+        scenario = self.app_obj.get_scenario(
             study_name, scenario_misfit_name)
         run = RunMisfit(scenario, run_misfit[0])
         run.state = LookupState.COMPLETED
@@ -422,7 +593,7 @@ class ObjFunRoutesRuns(ObjFunBase):
 
     def test_get_all_runs(self):
         response = self.app.get(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/runs',
+            f'{scenario_misfit_url}/runs',
             headers=headers)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(
@@ -431,10 +602,41 @@ class ObjFunRoutesRuns(ObjFunBase):
                        'state': LookupState.COMPLETED.name,
                        'value': run_misfit[1]}]})
 
+    def test_query_counts(self):
+        # the number of statements does not grow with the number of rows
+        scenario = self.app_obj.get_scenario(
+            study_name, scenario_misfit_name)
+        for i in range(5):
+            RunMisfit(scenario, {'paramA': i, 'paramB': 10 + i},
+                      state=LookupState.NEW)
+        db.session.commit()
+        db.session.remove()
+        base = scenario_misfit_url
+        for method, url, data, status, expected in [
+                ('get', '/api/studies', None, 200, 2),
+                ('get', f'/api/studies/{study_name}', None, 200, 4),
+                ('get', f'/api/studies/{study_name}/scenarios', None, 200, 4),
+                ('get', f'{base}/runs', None, 200, 4),
+                ('get', f'{base}/runs/1', None, 200, 2),
+                ('get', f'{base}/runs/1/state', None, 200, 2),
+                ('get', f'{base}/runs/1/value', None, 200, 2),
+                # the run values are not loaded with a single run
+                ('post', f'{base}/get_run',
+                 {'parameters': run_misfit[0]}, 201, 5),
+                # the run values are loaded with their subclass columns
+                ('post', f'{base}/runs/with_state',
+                 {'state': 'COMPLETED'}, 201, 5)]:
+            with self.subTest(url=url):
+                with self.count_queries() as queries:
+                    response = getattr(self.app, method)(
+                        url, json=data, headers=headers)
+                self.assertEqual(response.status_code, status)
+                self.assertEqual(len(queries), expected, queries)
+                db.session.remove()
+
     def test_get_run_by_params_fail_wrong_json(self):
         response = self.app.post(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'get_run', json={}, headers=headers)
+            f'{scenario_misfit_url}/get_run', json={}, headers=headers)
         self.assertEqual(response.status_code, 400)
 
     def test_get_run_by_params_fail_no_study(self):
@@ -445,15 +647,15 @@ class ObjFunRoutesRuns(ObjFunBase):
 
     def test_get_run_by_params_fail_wrong_params(self):
         response = self.app.post(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'get_run', json={'parameters': {'paramA': 1, 'paramB': 2}},
+            f'{scenario_misfit_url}/get_run',
+            json={'parameters': {'paramA': 1, 'paramB': 2}},
             headers=headers)
         self.assertEqual(response.status_code, 404)
 
     def test_get_run_by_params(self):
         response = self.app.post(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'get_run', json={'parameters': run_misfit[0]},
+            f'{scenario_misfit_url}/get_run',
+            json={'parameters': run_misfit[0]},
             headers=headers)
         self.assertEqual(response.status_code, 201)
         self.assertEqual(
@@ -464,8 +666,7 @@ class ObjFunRoutesRuns(ObjFunBase):
 
     def test_lookup_run_fail_wrong_json(self):
         response = self.app.post(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'lookup_run', json={}, headers=headers)
+            f'{scenario_misfit_url}/lookup_run', json={}, headers=headers)
         self.assertEqual(response.status_code, 400)
 
     def test_lookup_run_fail_no_study(self):
@@ -476,17 +677,30 @@ class ObjFunRoutesRuns(ObjFunBase):
 
     def test_lookup_run_new_run(self):
         response = self.app.post(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'lookup_run', json={'parameters': {'paramA': 1, 'paramB': 2}},
+            f'{scenario_misfit_url}/lookup_run',
+            json={'parameters': {'paramA': 1, 'paramB': 2}},
             headers=headers)
         self.assertEqual(response.status_code, 201)
         self.assertEqual(response.json,
                          {'status': 'provisional'})
 
+    def test_lookup_run_waiting(self):
+        for params, status in [({'paramA': 1, 'paramB': 2}, 'provisional'),
+                               ({'paramA': 2, 'paramB': 2}, 'waiting'),
+                               ({'paramA': 2, 'paramB': 2}, 'provisional')]:
+            response = self.app.post(
+                f'{scenario_misfit_url}/lookup_run',
+                json={'parameters': params},
+                headers=headers)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.json, {'status': status})
+        self.assertEqual(RunMisfit.query.count(), 2)
+        self.assertEqual(RunParameters.query.count(), 4)
+
     def test_lookup_run(self):
         response = self.app.post(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'lookup_run', json={'parameters': run_misfit[0]},
+            f'{scenario_misfit_url}/lookup_run',
+            json={'parameters': run_misfit[0]},
             headers=headers)
         self.assertEqual(response.status_code, 201)
         self.assertEqual(
@@ -495,41 +709,25 @@ class ObjFunRoutesRuns(ObjFunBase):
              'state': LookupState.COMPLETED.name,
              'value': run_misfit[1]})
 
-    def test_get_run_with_state_fail_wrong_json(self):
-        response = self.app.post(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/with_state', json={}, headers=headers)
-        self.assertEqual(response.status_code, 400)
-
-    def test_get_run_with_state_fail_wrong_state(self):
-        response = self.app.post(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/with_state', json={'state': 'wrong'}, headers=headers)
-        self.assertEqual(response.status_code, 400)
-
-    def test_get_run_with_state_fail_wrong_new_state(self):
-        response = self.app.post(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/with_state', json={'state': 'NEW', 'new_state': 'wrong'},
-            headers=headers)
-        self.assertEqual(response.status_code, 400)
-
-    def test_get_run_with_state_fail_no_study(self):
-        response = self.app.post(
-            f'/api/studies/wrong_study/scenarios/{scenario_misfit_name}/'
-            'runs/with_state', json={'state': 'NEW'}, headers=headers)
-        self.assertEqual(response.status_code, 400)
-
-    def test_get_run_with_state_fail_no_such_state(self):
-        response = self.app.post(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/with_state', json={'state': 'NEW'}, headers=headers)
-        self.assertEqual(response.status_code, 404)
+    def test_get_run_with_state_fail(self):
+        url = f'{scenario_misfit_url}/runs/with_state'
+        for name, bad_url, data, status in [
+                ('wrong_json', url, {}, 400),
+                ('wrong_state', url, {'state': 'wrong'}, 400),
+                ('wrong_new_state', url,
+                 {'state': 'NEW', 'new_state': 'wrong'}, 400),
+                ('no_study',
+                 f'/api/studies/wrong_study/scenarios/{scenario_misfit_name}/'
+                 'runs/with_state', {'state': 'NEW'}, 400),
+                ('no_such_state', url, {'state': 'NEW'}, 404)]:
+            with self.subTest(name):
+                response = self.app.post(bad_url, json=data, headers=headers)
+                self.assertEqual(response.status_code, status)
 
     def test_get_run_with_state(self):
         response = self.app.post(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/with_state', json={'state': 'COMPLETED'}, headers=headers)
+            f'{scenario_misfit_url}/runs/with_state',
+            json={'state': 'COMPLETED'}, headers=headers)
         self.assertEqual(response.status_code, 201)
         self.assertEqual(response.json,
                          {'id': 1,
@@ -539,14 +737,12 @@ class ObjFunRoutesRuns(ObjFunBase):
 
     def test_get_run_by_id_fail_wrong_id(self):
         response = self.app.get(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/10', headers=headers)
+            f'{scenario_misfit_url}/runs/10', headers=headers)
         self.assertEqual(response.status_code, 404)
 
     def test_get_run_by_id(self):
         response = self.app.get(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/1', headers=headers)
+            f'{scenario_misfit_url}/runs/1', headers=headers)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json,
                          {'id': 1,
@@ -555,86 +751,99 @@ class ObjFunRoutesRuns(ObjFunBase):
 
     def test_run_state_fail_wrong_id(self):
         response = self.app.get(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/10/state', headers=headers)
+            f'{scenario_misfit_url}/runs/10/state', headers=headers)
         self.assertEqual(response.status_code, 404)
 
     def test_get_run_state(self):
         response = self.app.get(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/1/state', headers=headers)
+            f'{scenario_misfit_url}/runs/1/state', headers=headers)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json, {'state': LookupState.COMPLETED.name})
 
-    def test_put_run_state_fail_wrong_json(self):
-        response = self.app.put(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/1/state', json={}, headers=headers)
-        self.assertEqual(response.status_code, 400)
-
-    def test_put_run_state_fail_wrong_state(self):
-        response = self.app.put(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/1/state', json={'state': 'wrong'}, headers=headers)
-        self.assertEqual(response.status_code, 400)
+    def test_get_run_state_not_modified(self):
+        url = f'{scenario_misfit_url}/runs/1/state'
+        response = self.app.get(url, headers=headers)
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        etag = response.headers['ETag']
+        response = self.app.get(
+            url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        # the tag changes with the state
+        response = self.app.put(url, json={'state': 'ACTIVE'},
+                                headers=headers)
+        response = self.app.get(
+            url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'state': 'ACTIVE'})
+
+    def test_put_run_state_fail(self):
+        url = f'{scenario_misfit_url}/runs/1/state'
+        for name, bad_url, data, status in [
+                ('wrong_json', url, {}, 400),
+                ('wrong_state', url, {'state': 'wrong'}, 400),
+                ('wrong_id',
+                 f'/api/studies/{study_name}/scenarios/{scenario_path_name}/'
+                 'runs/1/state', {'state': 'NEW'}, 404)]:
+            with self.subTest(name):
+                response = self.app.put(bad_url, json=data, headers=headers)
+                self.assertEqual(response.status_code, status)
 
     def test_put_run_state(self):
         response = self.app.put(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/1/state', json={'state': 'NEW'}, headers=headers)
+            f'{scenario_misfit_url}/runs/1/state',
+            json={'state': 'NEW'}, headers=headers)
         self.assertEqual(response.status_code, 201)
+        run = self.app_obj.get_run(study_name, scenario_misfit_name, 1)
+        self.assertEqual(run.state, LookupState.NEW)
 
     def test_run_value_fail_wrong_id(self):
         response = self.app.get(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/10/value', headers=headers)
+            f'{scenario_misfit_url}/runs/10/value', headers=headers)
         self.assertEqual(response.status_code, 404)
 
     def test_get_run_value(self):
         response = self.app.get(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/1/value', headers=headers)
+            f'{scenario_misfit_url}/runs/1/value', headers=headers)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json,
                          {'value': run_misfit[1]})
 
     def test_put_run_value_fail_wrong_json1(self):
         response = self.app.put(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/1/value', headers=headers)
-        self.assertEqual(response.status_code, 400)
+            f'{scenario_misfit_url}/runs/1/value', headers=headers)
+        self.assertEqual(response.status_code, 415)
 
     def test_put_run_value_fail_wrong_state(self):
         response = self.app.put(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/1/value', json={'value': 10}, headers=headers)
+            f'{scenario_misfit_url}/runs/1/value',
+            json={'value': 10}, headers=headers)
         self.assertEqual(response.status_code, 403)
 
     def test_put_run_value_fail_wrong_json2(self):
-        scenario = self.get_app().get_scenario(
+        scenario = self.app_obj.get_scenario(
             study_name, scenario_misfit_name)
         run = RunMisfit(scenario, {'paramA': 0, 'paramB': 20})
         run.state = LookupState.RUN
         db.session.commit()
         response = self.app.put(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/2/value', json={'wrong': 10}, headers=headers)
+            f'{scenario_misfit_url}/runs/2/value',
+            json={'wrong': 10}, headers=headers)
         self.assertEqual(response.status_code, 400)
 
     def test_put_run_value(self):
-        scenario = self.get_app().get_scenario(
+        scenario = self.app_obj.get_scenario(
             study_name, scenario_misfit_name)
         run = RunMisfit(scenario, {'paramA': 0, 'paramB': 20})
         run.state = LookupState.RUN
         db.session.commit()
         response = self.app.put(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/2/value', json={'value': 10}, headers=headers)
+            f'{scenario_misfit_url}/runs/2/value',
+            json={'value': 10}, headers=headers)
         self.assertEqual(response.status_code, 201)
 
     def test_put_run_value_force(self):
         response = self.app.put(
-            f'/api/studies/{study_name}/scenarios/{scenario_misfit_name}/'
-            'runs/1/value', json={'value': 10, 'force': True},
+            f'{scenario_misfit_url}/runs/1/value',
+            json={'value': 10, 'force': True},
             headers=headers)
         self.assertEqual(response.status_code, 201)